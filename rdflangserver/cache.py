@@ -1,14 +1,23 @@
 from __future__ import annotations
 
+import json
 import logging
 import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
 from os.path import expanduser
 from pathlib import Path
+from urllib.error import HTTPError
 from urllib.parse import quote
+from urllib.request import Request, urlopen
 
 from rdflib import ConjunctiveGraph, Graph, URIRef  # type: ignore[import]
 from rdflib.namespace import XMLNS  # type: ignore[import]
-from rdflib.parser import create_input_source  # type: ignore[import]
+from rdflib.parser import Parser  # type: ignore[import]
+from rdflib.plugin import PluginException, get  # type: ignore[import]
 from rdflib.util import guess_format  # type: ignore[import]
 
 XDG_CACHE_HOME = os.environ.get('XDG_CACHE_HOME', expanduser('~/.cache'))
@@ -20,6 +29,15 @@ RDF_GRAPH_CACHE_DIRS = [
     '/usr/local/share/rdf-graph-cache/',
 ]
 
+# rdflib store plugin for the graph cache; the default 'Memory' store keeps
+# SPO, POS and OSP indexes (set to e.g. 'Oxigraph' if oxrdflib is installed)
+RDF_GRAPH_STORE = os.environ.get('RDF_GRAPH_STORE', 'Memory')
+
+ACCEPT_RDF = (
+    'text/turtle, application/rdf+xml;q=0.9, application/ld+json;q=0.8, '
+    'application/n-triples;q=0.7, text/html;q=0.5, */*;q=0.1'
+)
+
 VOCAB_SOURCE_MAP = {
     "http://schema.org/": "http://schema.org/docs/schema_org_rdfa.html",
     # "http://www.w3.org/2001/XMLSchema#": "./xsd.ttl",
@@ -45,91 +63,304 @@ logger = logging.getLogger(__name__)
 
 class GraphCache:
 
+    MAX_CONTEXTS = 32
+    FETCH_TIMEOUT = 5  # seconds
+
     cachedir: Path
     graph: ConjunctiveGraph
-    mtime_map: dict[str, str]
+    mtime_map: dict[str, float]
 
     def __init__(self, cachedir: Path | str | None):
         self.cachedir = Path(cachedir) if cachedir else find_rdf_graph_cache_dir()
-        self.graph = ConjunctiveGraph()
+        self.graph = ConjunctiveGraph(store=RDF_GRAPH_STORE)
         self.mtime_map = {}
+        # guards graph and the context bookkeeping (rdflib is not thread-safe)
+        self.lock = threading.RLock()
+        # loaded context ids, least recently used first
+        self._loaded_contexts: OrderedDict[str, None] = OrderedDict()
 
     def load(self, url):
         src = VOCAB_SOURCE_MAP.get(str(url), url)
-        if os.path.isfile(url):
-            context_id = create_input_source(url).getPublicId()
+        try:
+            st = os.stat(url)
+        except (OSError, ValueError):
+            st = None
+
+        if st is not None and stat.S_ISREG(st.st_mode):
+            context_id = Path(url).resolve().as_uri()
             last_vocab_mtime = self.mtime_map.get(url)
-            vocab_mtime = os.stat(url).st_mtime
-            if not last_vocab_mtime or last_vocab_mtime < vocab_mtime:
+            vocab_mtime = st.st_mtime
+            if (
+                not last_vocab_mtime
+                or last_vocab_mtime < vocab_mtime
+                or context_id not in self._loaded_contexts
+            ):
                 logger.debug("Parse file: '%s'", url)
-                self.mtime_map[url] = vocab_mtime
                 # use CG as workaround for json-ld always loading as dataset
                 graph = ConjunctiveGraph()
                 graph.parse(src, format=guess_format(src))
-                self.graph.remove_context(context_id)
-                for s, p, o in graph:
-                    self.graph.add((s, p, o, context_id))
+                with self.lock:
+                    self.mtime_map[url] = vocab_mtime
+                    self.graph.remove_context(self.graph.get_context(context_id))
+                    for s, p, o in graph:
+                        self.graph.add((s, p, o, context_id))
+                    self._use_context(context_id)
                 return graph
         else:
             context_id = url
 
-        if any(self.graph.triples((None, None, None), context=context_id)):
-            logger.debug("Using context <%s>", context_id)
-            return self.graph.get_context(context_id)
+        with self.lock:
+            if context_id in self._loaded_contexts:
+                logger.debug("Using context <%s>", context_id)
+                self._loaded_contexts.move_to_end(context_id)
+                return self.graph.get_context(context_id)
 
         cache_path = self.get_fs_path(url)
-        if cache_path.exists() and cache_path.stat().st_size > 0:
-            logger.debug("Load local copy of <%s> from '%s'", context_id, cache_path)
-            return self.graph.parse(
-                str(cache_path), format='turtle', publicID=context_id
-            )
-        else:
-            logger.debug("Fetching <%s> to '%s'", context_id, cache_path)
-            graph = self.graph.parse(
-                src, format='rdfa' if url.endswith('html') else None
-            )
+        has_copy = cache_path.exists() and cache_path.stat().st_size > 0
+
+        # network access is done without holding the lock
+        fetched = None
+        if src.startswith(('http://', 'https://')):
+            try:
+                fetched = self._fetch(src, cache_path if has_copy else None)
+            except Exception as e:
+                if not has_copy:
+                    raise
+                logger.debug("Could not refresh <%s>: %s", src, e)
+
+        with self.lock:
+            # parse into the named context (ConjunctiveGraph.parse may not)
+            context = self.graph.get_context(context_id)
+            if fetched is not None:
+                logger.debug("Fetching <%s> to '%s'", context_id, cache_path)
+                data, fmt, location, validators = fetched
+                if url.endswith('html'):
+                    fmt = 'rdfa'
+                try:
+                    context.parse(data=data, format=fmt, publicID=location)
+                except Exception as e:
+                    if not has_copy:
+                        raise
+                    logger.debug("Could not parse <%s>: %s", src, e)
+                    context.remove((None, None, None))
+                    fetched = None
+                else:
+                    self._save_copy(context, cache_path, validators)
+
+            if fetched is None:
+                if has_copy:
+                    logger.debug(
+                        "Load local copy of <%s> from '%s'", context_id, cache_path
+                    )
+                    context.parse(
+                        str(cache_path), format='turtle', publicID=context_id
+                    )
+                else:
+                    logger.debug("Fetching <%s> to '%s'", context_id, cache_path)
+                    context.parse(src, format='rdfa' if url.endswith('html') else None)
+                    self._save_copy(context, cache_path)
+
+            self._use_context(context_id)
+        return context
+
+    def _use_context(self, context_id: str) -> None:
+        self._loaded_contexts[context_id] = None
+        self._loaded_contexts.move_to_end(context_id)
+        while len(self._loaded_contexts) > self.MAX_CONTEXTS:
+            evicted, _ = self._loaded_contexts.popitem(last=False)
+            logger.debug("Evicting context <%s>", evicted)
+            # remove_context would keep the emptied context registered
+            self.graph.store.remove_graph(self.graph.get_context(evicted))
+
+    def _save_copy(
+        self, context: Graph, cache_path: Path, validators: dict | None = None
+    ) -> None:
+        # the parsed context is used even if the copy cannot be written
+        try:
             with cache_path.open('wb') as f:
-                graph.serialize(f, format='turtle')
-            return graph
+                context.serialize(f, format='turtle')
+            if validators is not None:
+                validators['mtime'] = cache_path.stat().st_mtime
+                with self._get_meta_path(cache_path).open('w') as f:
+                    json.dump(validators, f)
+        except OSError as e:
+            logger.debug("Could not save copy to '%s': %s", cache_path, e)
 
     def get_fs_path(self, url: str) -> Path:
         return self.cachedir / (quote(url, safe="") + '.ttl')
 
+    def _get_meta_path(self, cache_path: Path) -> Path:
+        return cache_path.with_name(cache_path.name + '.meta')
+
+    def _fetch(
+        self, src: str, cache_path: Path | None
+    ) -> tuple[bytes, str | None, str, dict] | None:
+        """
+        Fetch src, conditionally if there is a cached copy. Returns None if
+        the copy is still current.
+        """
+        headers = {'Accept': ACCEPT_RDF}
+        if cache_path:
+            headers.update(self._get_conditional_headers(cache_path))
+
+        try:
+            req = Request(src, headers=headers)
+            with urlopen(req, timeout=self.FETCH_TIMEOUT) as res:
+                data = res.read()
+                location = res.geturl()
+                fmt = res.headers.get_content_type()
+                validators = {
+                    'etag': res.headers.get('ETag'),
+                    'last_modified': res.headers.get('Last-Modified'),
+                }
+        except HTTPError as e:
+            if e.code == 304:
+                logger.debug("Not modified: <%s>", src)
+                return None
+            raise
+
+        try:
+            get(fmt, Parser)
+        except PluginException:
+            fmt = guess_format(location)
+
+        return data, fmt, location, validators
+
+    def _get_conditional_headers(self, cache_path: Path) -> dict[str, str]:
+        meta_path = self._get_meta_path(cache_path)
+        mtime = cache_path.stat().st_mtime
+        meta = {}
+        if meta_path.exists():
+            try:
+                with meta_path.open() as f:
+                    meta = json.load(f)
+            except ValueError:
+                pass
+
+        headers = {}
+        if meta.get('mtime') == mtime:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        else:  # copy without (current) metadata
+            headers['If-Modified-Since'] = formatdate(mtime, usegmt=True)
+
+        return headers
+
 
 class PrefixCache:
 
     PREFIX_URI_TEMPLATE = 'http://prefix.cc/{pfx}.file.ttl'
+    ALL_PREFIXES_URI = 'http://prefix.cc/popular/all.file.ttl'
+    MAX_AGE_DAYS = 30
+    RETRY_DAYS = 1
+    FETCH_TIMEOUT = 5  # seconds
 
     def __init__(self, prefix_file):
         self._prefix_file = prefix_file
         self._pfxgraph = Graph()
+        self._bulk_checked = False
         if os.path.isfile(self._prefix_file):
             self._pfxgraph.parse(str(self._prefix_file), format='turtle')
 
     def lookup(self, pfx):
         ns = self._pfxgraph.store.namespace(pfx)
+        if not ns and self._check_bulk():
+            ns = self._pfxgraph.store.namespace(pfx)
         return ns or self._fetch_ns(pfx)
 
     def prefix(self, uri):
         return self._pfxgraph.store.prefix(URIRef(uri.decode('utf-8')))
 
     def namespaces(self):
+        self._check_bulk()
         return self._pfxgraph.namespaces()
 
+    def _check_bulk(self) -> bool:
+        """
+        Fetch all prefixes, at most once per process, if the last bulk fetch
+        is too old (or failed too long ago). Returns True if fetched.
+        """
+        if self._bulk_checked:
+            return False
+        self._bulk_checked = True
+
+        meta_path = self._get_meta_path()
+        meta = {}
+        if meta_path and meta_path.exists():
+            try:
+                with meta_path.open() as f:
+                    meta = json.load(f)
+            except ValueError:
+                pass
+
+        day = 24 * 60 * 60
+        now = time.time()
+        if meta.get('fetched') and now - meta['fetched'] < self.MAX_AGE_DAYS * day:
+            return False
+        if meta.get('attempted') and now - meta['attempted'] < self.RETRY_DAYS * day:
+            return False
+
+        fetched = self._fetch_all()
+        meta['attempted'] = now
+        if fetched:
+            meta['fetched'] = now
+        if meta_path:
+            try:
+                with meta_path.open('w') as f:
+                    json.dump(meta, f)
+            except OSError as e:
+                logger.debug("Could not save '%s': %s", meta_path, e)
+
+        return fetched
+
+    def _get_meta_path(self) -> Path | None:
+        if not self._prefix_file:
+            return None
+        return self._prefix_file.with_name(self._prefix_file.name + '.meta')
+
+    def _fetch_all(self) -> bool:
+        url = self.ALL_PREFIXES_URI
+        logger.debug("Fetching <%s>", url)
+        try:
+            self._parse_url(url)
+        except:
+            logger.debug("Could not read <%s>", url)
+            return False
+
+        self._save_prefixes(self._pfxgraph.namespaces(), 'w')
+        return True
+
     def _fetch_ns(self, pfx):
         url = self.PREFIX_URI_TEMPLATE.format(pfx=pfx)
         logger.debug("Fetching <%s>", url)
+        known = set(self._pfxgraph.namespaces())
         try:
-            self._pfxgraph.parse(url, format='turtle')
+            self._parse_url(url)
         except:  # not found
             logger.debug("Could not read <%s>", url)
 
-        if self._prefix_file:
-            logger.debug("Saving prefixes to '%s'", self._prefix_file)
-            with self._prefix_file.open('w') as f:
-                for pfx, ns in self._pfxgraph.namespaces():
+        added = [item for item in self._pfxgraph.namespaces() if item not in known]
+        if added:
+            self._save_prefixes(added, 'a')
+
+        return self._pfxgraph.store.namespace(pfx)
+
+    def _parse_url(self, url):
+        with urlopen(url, timeout=self.FETCH_TIMEOUT) as res:
+            data = res.read()
+        self._pfxgraph.parse(data=data, format='turtle', publicID=url)
+
+    def _save_prefixes(self, namespaces, mode):
+        if not self._prefix_file:
+            return
+        logger.debug("Saving prefixes to '%s'", self._prefix_file)
+        try:
+            with self._prefix_file.open(mode) as f:
+                for pfx, ns in namespaces:
                     if str(ns) == str(XMLNS):
                         continue
                     print(f"@prefix {pfx}: <{ns}> .", file=f)
-
-        return self._pfxgraph.store.namespace(pfx)
+        except OSError as e:
+            logger.debug("Could not save '%s': %s", self._prefix_file, e)
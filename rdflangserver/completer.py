@@ -1,8 +1,11 @@
 from __future__ import annotations
 
 import re
+import threading
+from bisect import bisect_left
 from itertools import chain
-from typing import Iterable, NamedTuple
+from sys import intern
+from typing import Iterable, NamedTuple, Protocol
 
 from rdflib import ConjunctiveGraph
 from rdflib.namespace import RDF, RDFS, split_uri  # type: ignore[import]
@@ -10,30 +13,133 @@ from rdflib.plugins.parsers.notation3 import BadSyntax
 
 from .cache import GraphCache, PrefixCache
 from .keywords import LANG_KEYWORDS
-from .utils import get_term_at
+from .utils import LinesIO, get_term_at, starts_with_term
 
 MAX_LINE_SCAN = 80
 MATCH_NS_DECL = re.compile(
     r'''(?:@prefix\s+|xmlns:?|vocab|prefix\s+|PREFIX\s+|")(?:@vocab|(\w*))"?[:=]\s*[<"'"](.+?)[>"']'''
 )
 
+MATCH_DIRECTIVE = re.compile(r'\s*@?(?:prefix|base)\b', re.IGNORECASE)
+# a line ending a Turtle statement (not in a comment, IRI or single-line string)
+MATCH_STATEMENT_END = re.compile(
+    r'''(?:[^#"'<]|<[^>\s]*>|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')*\.\s*$'''
+)
+
+INCREMENTAL_CHECK_LANGS = {'turtle'}
+
 Lines = list[str]
 
 
 def get_pfxns(line: str) -> Iterable[tuple[str, str]]:
-    return MATCH_NS_DECL.findall(line)
+    # cheap substring test for each alternative opening a MATCH_NS_DECL match
+    if (
+        'prefix' not in line
+        and 'PREFIX' not in line
+        and 'xmlns' not in line
+        and 'vocab' not in line
+        and '"' not in line
+    ):
+        return ()
+    return [(intern(pfx), intern(ns)) for pfx, ns in MATCH_NS_DECL.findall(line)]
 
 
 def get_pfxns_map(buffer: Lines) -> dict[str, str]:
     return {pfx: ns for line in buffer[:MAX_LINE_SCAN] for pfx, ns in get_pfxns(line)}
 
 
+def get_changed_statements(old: Lines, new: Lines) -> Lines | None:
+    """
+    Get the statements in new that differ from old (a valid document),
+    preceded by the directives in effect for them. Returns None if the change
+    cannot be checked in isolation.
+
+    >>> old = [
+    ...     '@prefix ex: <http://example.org/> .\\n',
+    ...     'ex:a ex:b ex:c ;\\n',
+    ...     '    ex:d ex:e .\\n',
+    ...     'ex:f ex:g ex:h .\\n',
+    ...     'ex:i ex:j ex:k .\\n',
+    ... ]
+    >>> get_changed_statements(old, old)
+    []
+
+    An edit is widened to whole statements, ending in unchanged text:
+
+    >>> new = old[:2] + ['    ex:d ex:x .\\n'] + old[3:]
+    >>> for l in get_changed_statements(old, new):
+    ...     print(l, end='')
+    @prefix ex: <http://example.org/> .
+    ex:a ex:b ex:c ;
+        ex:d ex:x .
+    ex:f ex:g ex:h .
+
+    Removing a statement end joins it with the next statement:
+
+    >>> new = old[:2] + ['    ex:d ex:e\\n'] + old[3:]
+    >>> for l in get_changed_statements(old, new):
+    ...     print(l, end='')
+    @prefix ex: <http://example.org/> .
+    ex:a ex:b ex:c ;
+        ex:d ex:e
+    ex:f ex:g ex:h .
+
+    Changed directives and long strings require a full parse:
+
+    >>> print(get_changed_statements(old, ['@prefix ex: <urn:x:> .\\n'] + old[1:]))
+    None
+    >>> print(get_changed_statements(old, old[:4] + ['ex:i ex:j \"\"\"k\"\"\" .\\n']))
+    None
+    """
+    if any('"""' in l or "'''" in l for l in chain(old, new)):
+        return None
+
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+
+    if start == len(old) == len(new):
+        return []
+
+    while start > 0 and not MATCH_STATEMENT_END.match(new[start - 1]):
+        start -= 1
+
+    stop = len(new) - end
+    while stop < len(new) and not MATCH_STATEMENT_END.match(new[stop]):
+        stop += 1
+    stop = min(stop + 1, len(new))
+
+    old_stop = stop - len(new) + len(old)
+    changed = chain(new[start:stop], old[start:old_stop])
+    if any(MATCH_DIRECTIVE.match(l) for l in changed):
+        return None
+
+    header = [l for l in new[:start] if MATCH_DIRECTIVE.match(l)]
+    return header + new[start:stop]
+
+
+class Document(Protocol):
+    uri: str
+    version: int | None
+    lines: Lines
+
+
 class Completion(NamedTuple):
     label: str
     detail: str | None = None
     documentation: str | None = None
 
 
+class VocabTerms(NamedTuple):
+    labels: list[str]
+    details: list[str | None]
+    docs: list[str | None]
+
+
 class RdfCompleter:
     graphcache: GraphCache
     prefixes: PrefixCache
@@ -42,29 +148,91 @@ class RdfCompleter:
         self.graphcache = GraphCache(cachedir)
         self.prefixes = PrefixCache(self.graphcache.cachedir / 'prefixes.ttl')
         self._terms_by_ns = {}
+        # one lock per namespace, so each vocabulary is loaded only once
+        self._ns_locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
         self._keywords = LANG_KEYWORDS
+        self._pfxns_cache: dict[
+            str, tuple[int, dict[str, str], dict[str, str]]
+        ] = {}
+        self._checked: dict[str, Lines] = {}
+        self._open_uris: set[str] = set()
+
+    def get_pfxns_map(self, document: Document) -> dict[str, str]:
+        return self._get_ns_maps(document)[0]
+
+    def _get_ns_maps(
+        self, document: Document
+    ) -> tuple[dict[str, str], dict[str, str]]:
+        version = document.version
+        cached = self._pfxns_cache.get(document.uri)
+        if version is not None and cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+
+        pfxns = get_pfxns_map(document.lines)
+        # reversed to keep the first prefix declared for a namespace
+        nspfx = {ns: pfx for pfx, ns in reversed(pfxns.items())}
+        if version is not None:
+            self._pfxns_cache[document.uri] = version, pfxns, nspfx
+        return pfxns, nspfx
+
+    def forget(self, uri: str) -> None:
+        self._pfxns_cache.pop(uri, None)
+
+    def open(self, uri: str) -> None:
+        self._open_uris.add(uri)
+
+    def close(self, uri: str) -> None:
+        self._open_uris.discard(uri)
+        self.forget(uri)
+        self._checked.pop(uri, None)
 
     def get_vocab_terms(self, ns):
         terms = self._terms_by_ns.get(ns)
         if terms is None and ns:
-            graph = self.graphcache.load(ns)
-            self._collect_vocab_terms(graph, ns)
+            with self._get_ns_lock(ns):
+                if ns not in self._terms_by_ns:
+                    # fetch without holding the graph lock...
+                    self.graphcache.load(ns)
+                    with self.graphcache.lock:
+                        # ...then get it again, in case other loads evicted it
+                        graph = self.graphcache.load(ns)
+                        self._collect_vocab_terms(graph, ns)
         return self._terms_by_ns.get(ns)
 
+    def _get_ns_lock(self, ns) -> threading.Lock:
+        with self._lock:
+            return self._ns_locks.setdefault(ns, threading.Lock())
+
     def _collect_vocab_terms(self, graph, ns):
         terms = {}
-        items = set(graph.subjects(RDF.type | RDFS.isDefinedBy, None))
-        for subject in items:
-            try:
-                uri, leaf = split_uri(subject)
-                if uri == str(ns) and leaf:
-                    terms[leaf] = graph.resource(subject)
-            except:
-                pass
-        self._terms_by_ns[ns] = terms  # TODO: OrderedDict
+        seen = set()
+        ns_str = str(ns)
+        for pred in (RDF.type, RDFS.isDefinedBy):
+            for subject in graph.subjects(pred, None):
+                if subject in seen:
+                    continue
+                seen.add(subject)
+                try:
+                    uri, leaf = split_uri(subject)
+                except:
+                    continue
+                if leaf and uri == ns_str:
+                    terms[leaf] = subject
+
+        labels = sorted(terms)
+        details = []
+        docs = []
+        for leaf in labels:
+            subject = terms[leaf]
+            typ = graph.value(subject, RDF.type)
+            details.append(graph.qname(typ) if typ else None)
+            doc = graph.value(subject, RDFS.comment)
+            docs.append(str(doc) if doc is not None else None)
+        self._terms_by_ns[ns] = VocabTerms(labels, details, docs)
 
     def get_completions(
-        self, buffer: Lines, line: str, col: int, lang: str | None = None
+        self, document: Document, line: str, col: int, lang: str | None = None
     ) -> list[Completion]:
         term = get_term_at(line, col - 1)
         assert term is not None
@@ -87,34 +255,31 @@ class RdfCompleter:
             else:
                 results = self._get_pfx_declarations(pfx_fmt, trail)
         else:
-            pfxns = get_pfxns_map(buffer)
+            pfxns = self.get_pfxns_map(document)
             ns = pfxns.get(pfx)
-            terms = self.get_vocab_terms(ns) or {}
+            terms = self.get_vocab_terms(ns)
+            labels = terms.labels if terms else []
             if ':' in term:
-                return sorted(
-                    Completion(
-                        key,
-                        res.value(RDF.type).qname() if res.value(RDF.type) else None,
-                        res.value(RDFS.comment),
-                    )
-                    for key, res in terms.items()
-                    if key.startswith(trail)
-                )
+                i = bisect_left(labels, trail)
+                end = i
+                while end < len(labels) and labels[end].startswith(trail):
+                    end += 1
+                return [
+                    Completion(labels[j], terms.details[j], terms.docs[j])
+                    for j in range(i, end)
+                ]
 
             keywords = self._keywords.get(lang, [])
-            curies = chain((pfx + ':' for pfx in sorted(pfxns)), terms, keywords)
+            curies = chain((pfx + ':' for pfx in sorted(pfxns)), labels, keywords)
             results = (curie for curie in curies if curie.startswith(trail))
 
         return [Completion(value) for value in results]
 
-    def expand_pfx(self, buffer: Lines, pfx: str) -> str | None:
-        return get_pfxns_map(buffer).get(pfx)
+    def expand_pfx(self, document: Document, pfx: str) -> str | None:
+        return self.get_pfxns_map(document).get(pfx)
 
-    def to_pfx(self, buffer: Lines, uri: str) -> str | None:
-        for pfx, ns in get_pfxns_map(buffer).items():
-            if ns == uri:
-                return pfx
-        return None
+    def to_pfx(self, document: Document, uri: str) -> str | None:
+        return self._get_ns_maps(document)[1].get(uri)
 
     def _get_pfx_declarations(self, pfx_fmt, base):
         return [
@@ -124,7 +289,7 @@ class RdfCompleter:
         ]
 
     def get_term(
-        self, buffer: Lines, line: str, col: int, lang: str | None = None
+        self, document: Document, line: str, col: int, lang: str | None = None
     ) -> tuple[str | None, str]:
         term = get_term_at(line, col)
         if not term:
@@ -134,27 +299,30 @@ class RdfCompleter:
             return None, ''
 
         pfx, lname = term.split(':', 1)
-        ns = self.expand_pfx(buffer, pfx)
+        ns = self.expand_pfx(document, pfx)
 
         return ns, lname or ''
 
     def find_term_definition(
-        self, lines: Lines, ns: str, lname: str
+        self,
+        lines: Lines,
+        ns: str,
+        lname: str,
+        pfx: str | None = None,
     ) -> tuple[int, int]:
-        prefixes: dict[str, str] = {}
-        expanded_term = f"<{ns}{lname}>"
+        # with the prefix for ns already known, there is no need to scan for it
+        ns_pfx_found = pfx is not None
+        defterm = f"{pfx}:{lname}" if pfx is not None else f"<{ns}{lname}>"
         col = -1
         for at_line, l in enumerate(lines):
-            if at_line < MAX_LINE_SCAN:
+            if not ns_pfx_found and at_line < MAX_LINE_SCAN:
                 for def_pfx, def_ns in get_pfxns(l):
-                    if def_ns not in prefixes:
-                        prefixes[def_ns] = def_pfx
-
-            dpfx = prefixes.get(ns)
-            defterm = f"{dpfx}:{lname}" if dpfx is not None else expanded_term
+                    if def_ns == ns:
+                        defterm = f"{def_pfx}:{lname}"
+                        ns_pfx_found = True
+                        break
 
-            m = re.search(fr"^{re.escape(defterm)}\b", l)
-            if m:
+            if starts_with_term(l, defterm):
                 col = 0
                 break
         else:
@@ -163,21 +331,49 @@ class RdfCompleter:
 
         return at_line, col
 
-    def check(self, buffer: Lines, lang: str | None = None) -> Iterable:
+    def check(
+        self, buffer: Lines, lang: str | None = None, uri: str | None = None
+    ) -> Iterable:
         if lang == 'sparql':
             return
+
+        # keep a snapshot of valid lines only for open documents to diff against
+        incremental = uri in self._open_uris and lang in INCREMENTAL_CHECK_LANGS
+        checked = self._checked.pop(uri, None) if incremental else None
+        if checked is not None:
+            changed = get_changed_statements(checked, buffer)
+            if changed is not None:
+                try:
+                    if changed:
+                        ConjunctiveGraph().parse(source=LinesIO(changed), format=lang)
+                    self._keep_checked(uri, buffer)
+                    return
+                except BadSyntax:
+                    pass  # reparse all to locate the error
+
         try:
-            # TODO: io wrapper to iterate over buffer directly?
-            data = ''.join(buffer)
-            ConjunctiveGraph().parse(data=data, format=lang)
+            ConjunctiveGraph().parse(source=LinesIO(buffer), format=lang)
         except BadSyntax as e:
-            lastnl = data[: e._i].rfind('\n')
             if e._i >= 0:
-                col = e._i - lastnl - 1
+                # find the start of the line holding the error offset
+                line_start = 0
+                for l in buffer:
+                    if line_start + len(l) > e._i or not l.endswith('\n'):
+                        break
+                    line_start += len(l)
+                col = e._i - line_start
             else:
-                col = len(data)
+                col = sum(map(len, buffer))
 
             yield e.lines, col, e._why
+        else:
+            if incremental:
+                self._keep_checked(uri, buffer)
+
+    def _keep_checked(self, uri: str, buffer: Lines) -> None:
+        # the document may have been closed while it was being checked
+        if uri in self._open_uris:
+            self._checked[uri] = list(buffer)
 
 
 if __name__ == '__main__':
@@ -197,5 +393,5 @@ if __name__ == '__main__':
     rdfcompleter = RdfCompleter()
     uri = rdfcompleter.prefixes.lookup(pfx)
     print("%s: %s" % (pfx, uri))
-    for t in rdfcompleter.get_vocab_terms(uri):
+    for t in rdfcompleter.get_vocab_terms(uri).labels:
         print("    %s" % t)
@@ -1,15 +1,20 @@
 from __future__ import annotations
 
+import asyncio
+import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
 
 from lsprotocol.types import (TEXT_DOCUMENT_COMPLETION,
                               TEXT_DOCUMENT_DEFINITION,
-                              TEXT_DOCUMENT_DID_CHANGE, TEXT_DOCUMENT_DID_OPEN,
-                              TEXT_DOCUMENT_DID_SAVE, CompletionItem,
-                              CompletionList, CompletionOptions,
-                              CompletionParams, DefinitionOptions, Diagnostic,
-                              DiagnosticOptions, DidChangeTextDocumentParams,
+                              TEXT_DOCUMENT_DID_CHANGE, TEXT_DOCUMENT_DID_CLOSE,
+                              TEXT_DOCUMENT_DID_OPEN, TEXT_DOCUMENT_DID_SAVE,
+                              CompletionItem, CompletionList,
+                              CompletionOptions, CompletionParams,
+                              DefinitionOptions, Diagnostic, DiagnosticOptions,
+                              DidChangeTextDocumentParams,
+                              DidCloseTextDocumentParams,
                               DidOpenTextDocumentParams,
                               DidSaveTextDocumentParams, LocationLink,
                               Position, Range, TypeDefinitionParams)
@@ -22,13 +27,26 @@ server = LanguageServer('rdflangserver', 'v0.1')
 
 rdfcompleter = RdfCompleter()
 
+# seconds to wait for more changes before validating a document
+CHECK_DELAY = 0.3
+
+_check_tasks: dict[str, asyncio.Task] = {}
+
+# loads vocabularies declared in opened documents ahead of completion
+vocab_loader = ThreadPoolExecutor(max_workers=4)
+# languages where every matched declaration is a real prefix declaration (in
+# JSON-LD, any "key": "value" pair matches)
+WARM_VOCAB_LANGS = {'turtle', 'trig', 'n3', 'sparql', 'rdf', 'xml'}
+
+logger = logging.getLogger(__name__)
+
 
 # trigger_characters=[':', '=', ' ']
 @server.feature(TEXT_DOCUMENT_COMPLETION, CompletionOptions(resolve_provider=True))
 def completions(params: CompletionParams):
     document, line, pos = _get_doc_line_and_pos(params)
     values = rdfcompleter.get_completions(
-        document.lines, line, pos.character, lang=document.language_id
+        document, line, pos.character, lang=document.language_id
     )
     items = [
         CompletionItem(
@@ -51,7 +69,7 @@ def definition(params: TypeDefinitionParams):
     col = pos.character
 
     ns, lname = rdfcompleter.get_term(
-        document.lines, line, col, lang=document.language_id
+        document, line, col, lang=document.language_id
     )
     if not ns:
         return
@@ -61,7 +79,9 @@ def definition(params: TypeDefinitionParams):
     # Find line of symbol:
     document = server.workspace.get_document(quote(str(doc_uri)))
 
-    at_line, col = rdfcompleter.find_term_definition(document.lines, ns, lname)
+    # the prefix maps are only cached for open (versioned) documents
+    pfx = rdfcompleter.to_pfx(document, ns) if document.version is not None else None
+    at_line, col = rdfcompleter.find_term_definition(document.lines, ns, lname, pfx)
 
     pos = Position(line=at_line, character=col)
     rng = Range(start=pos, end=pos)
@@ -72,23 +92,56 @@ def definition(params: TypeDefinitionParams):
 
 @server.feature(TEXT_DOCUMENT_DID_OPEN)
 async def did_open(ls, params: DidOpenTextDocumentParams):
-    _check(ls, params)
+    document = ls.workspace.get_document(params.text_document.uri)
+    rdfcompleter.open(document.uri)
+    if document.language_id in WARM_VOCAB_LANGS:
+        for ns in set(rdfcompleter.get_pfxns_map(document).values()):
+            vocab_loader.submit(_load_vocab, ns)
+    _schedule_check(ls, params)
 
 
 @server.feature(TEXT_DOCUMENT_DID_CHANGE)
 async def did_change(ls, params: DidChangeTextDocumentParams):
-    _check(ls, params)
+    rdfcompleter.forget(params.text_document.uri)
+    _schedule_check(ls, params, CHECK_DELAY)
 
 
 @server.feature(TEXT_DOCUMENT_DID_SAVE)
 async def did_save(ls, params: DidSaveTextDocumentParams):
-    _check(ls, params)
+    _schedule_check(ls, params)
 
 
-def _check(ls, params):
-    document = ls.workspace.get_document(params.text_document.uri)
+@server.feature(TEXT_DOCUMENT_DID_CLOSE)
+async def did_close(ls, params: DidCloseTextDocumentParams):
+    pending = _check_tasks.pop(params.text_document.uri, None)
+    if pending:
+        pending.cancel()
+    rdfcompleter.close(params.text_document.uri)
+
+
+def _schedule_check(ls, params, delay=0.0):
+    uri = params.text_document.uri
+    pending = _check_tasks.pop(uri, None)
+    if pending:
+        pending.cancel()
+    _check_tasks[uri] = asyncio.create_task(_check(ls, uri, delay))
 
-    errors = rdfcompleter.check(document.lines, lang=document.language_id)
+
+async def _check(ls, uri, delay):
+    try:
+        if delay:
+            await asyncio.sleep(delay)
+
+        document = ls.workspace.get_document(uri)
+        lines = list(document.lines)
+
+        # parse off the event loop, on a snapshot of the buffer
+        errors = await asyncio.get_running_loop().run_in_executor(
+            None, _get_errors, lines, document.language_id, uri
+        )
+    finally:
+        if _check_tasks.get(uri) is asyncio.current_task():
+            del _check_tasks[uri]
 
     diagnostics = [
         Diagnostic(
@@ -101,6 +154,17 @@ def _check(ls, params):
     ls.publish_diagnostics(document.uri, diagnostics)
 
 
+def _load_vocab(ns):
+    try:
+        rdfcompleter.get_vocab_terms(ns)
+    except Exception as e:
+        logger.warning("Could not load vocabulary <%s>: %s", ns, e)
+
+
+def _get_errors(lines, lang, uri):
+    return list(rdfcompleter.check(lines, lang=lang, uri=uri))
+
+
 def _get_doc_line_and_pos(params):
     document = server.workspace.get_document(params.text_document.uri)
     pos = params.position
@@ -1,6 +1,8 @@
-import re
+import io
+import string
+from typing import Iterable
 
-NOT_TERM_CHAR = re.compile(r'[^:A-Za-z0-9-_]|$')
+TERM_CHARS = frozenset(string.ascii_letters + string.digits + ':-_')
 
 
 def get_term_at(line: str, i: int) -> str | None:
@@ -13,18 +15,88 @@ def get_term_at(line: str, i: int) -> str | None:
     'here'
     >>> get_term_at('<> a bibo:Article', 16)
     'bibo:Article'
+    >>> get_term_at('some rdf:term here', 13)
+    ''
     """
-    m = NOT_TERM_CHAR.search(line[i:])
-    if not m:
-        return None
-    front = m.span()[0]
+    n = len(line)
+    if not 0 <= i < n or line[i] not in TERM_CHARS:
+        return ''
 
-    m = NOT_TERM_CHAR.search(line[i::-1])
-    if not m:
-        return None
-    back = m.span()[0]
+    end = i + 1
+    while end < n and line[end] in TERM_CHARS:
+        end += 1
 
-    return line[i - back + 1 : i + front]
+    start = i
+    while start > 0 and line[start - 1] in TERM_CHARS:
+        start -= 1
+
+    return line[start:end]
+
+
+def starts_with_term(line: str, term: str) -> bool:
+    """
+    >>> starts_with_term('ex:term a owl:Class', 'ex:term')
+    True
+    >>> starts_with_term('ex:termination a owl:Class', 'ex:term')
+    False
+    >>> starts_with_term('ex:term-ination a owl:Class', 'ex:term')
+    False
+    >>> starts_with_term('<http://example.org/term> a owl:Class', '<http://example.org/term>')
+    True
+    """
+    if not line.startswith(term):
+        return False
+    end = len(term)
+    if end == len(line) or term.endswith('>'):
+        return True
+    c = line[end]
+    return not (c.isalnum() or c in '_-')
+
+
+class LinesIO(io.TextIOBase):
+    """
+    A read-only text stream over lines, without joining them up front.
+
+    >>> f = LinesIO(['one\\n', 'two\\n', 'three'])
+    >>> f.read(5), f.read(1), f.readline(), f.read()
+    ('one\\nt', 'w', 'o\\n', 'three')
+    >>> f.read()
+    ''
+    """
+
+    def __init__(self, lines: Iterable[str]):
+        self._lines = iter(lines)
+        self._rest = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> str:
+        if size is None or size < 0:
+            data = self._rest + ''.join(self._lines)
+            self._rest = ''
+            return data
+
+        chunks = [self._rest]
+        got = len(self._rest)
+        while got < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            got += len(line)
+
+        data = ''.join(chunks)
+        self._rest = data[size:]
+        return data[:size]
+
+    def readline(self, size: int | None = -1) -> str:
+        line = self._rest or next(self._lines, '')
+        if size is not None and 0 <= size < len(line):
+            line, self._rest = line[:size], line[size:]
+        else:
+            self._rest = ''
+        return line
 
 
 if __name__ == '__main__':